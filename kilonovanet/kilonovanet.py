@@ -1,11 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import json
 import os
+import warnings
+import weakref
 from pyphot import unit, Filter
 import torch
 
 from kilonovanet.cvae import CVAE
+from kilonovanet.observations import index_observations
 import numpy as np
 
+# the decoder is a small MLP evaluated on a handful of rows at a time, where thread start-up and
+# oversubscription (e.g. one sampler process per core) cost more than the matmuls themselves
+torch.set_num_threads(int(os.environ.get("KILONOVANET_TORCH_THREADS", 1)))
+
+# state dicts and traced inference decoders already built, so that every Model built from the same
+# weights file shares one copy of them. Keys include the file's modification time and size, so a
+# rewritten file is read again; entries are dropped once no Model uses them any more.
+_WEIGHTS_CACHE = weakref.WeakValueDictionary()
+_DECODER_CACHE = weakref.WeakValueDictionary()
+
+
+class _StateDict(dict):
+    # plain dicts cannot be weakly referenced, which _WEIGHTS_CACHE needs
+    pass
+
+
+def _weights_key(pytorch_weights_file_path):
+    path = os.path.abspath(pytorch_weights_file_path)
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+
+def _load_weights(weights_key):
+    state_dict = _WEIGHTS_CACHE.get(weights_key)
+    if state_dict is None:
+        state_dict = _StateDict(
+            torch.load(weights_key[0], map_location=torch.device("cpu"))
+        )
+        _WEIGHTS_CACHE[weights_key] = state_dict
+    return state_dict
+
+
+def _photon_weights(pyphot_filter, wavelengths):
+    """
+    Weights w such that spectra @ w equals pyphot_filter.get_flux(wavelengths, spectra) for a photon
+    counting filter, i.e. the trapezoid integral of lambda * T * f over that of lambda * T
+    :param pyphot_filter: filter to integrate through
+    :type pyphot_filter: class `pyphot.Filter`
+    :param wavelengths: wavelength grid of the spectra in Angstrom
+    :type wavelengths: np.ndarray
+    :return: weights, zero everywhere if the filter does not overlap the grid
+    """
+    transmission = pyphot_filter.reinterp(wavelengths * unit["AA"]).transmit
+    trapezoid_widths = np.zeros_like(wavelengths)
+    trapezoid_widths[:-1] += 0.5 * np.diff(wavelengths)
+    trapezoid_widths[1:] += 0.5 * np.diff(wavelengths)
+    weights = trapezoid_widths * wavelengths * transmission
+    norm = weights.sum()
+    return weights / norm if norm > 0 else weights
+
+
+def _load_filter(filter_file_path):
+    # returns the filter name (the filename sans .dat) and the pyphot filter
+    name = os.path.basename(filter_file_path)[:-4]
+    filter_data = np.loadtxt(filter_file_path)
+    pyphot_filter = Filter(
+        filter_data.T[0] * unit["AA"],
+        filter_data.T[1],
+        name=name,
+        dtype="photon",
+        unit="Angstrom",
+    )
+    return name, pyphot_filter
+
+
+def _exp_minus_bias(y, scale, offset, bias):
+    # exp(y * scale + offset) - bias, evaluated in float64 whatever the dtype of y: the two terms
+    # nearly cancel for faint parts of the spectra, which float32 cannot resolve
+    spectra = np.multiply(y, scale, dtype=np.float64)
+    spectra += offset
+    np.exp(spectra, out=spectra)
+    spectra -= bias
+    return spectra
+
 
 class Model:
     """
@@ -18,6 +97,9 @@ class Model:
         pytorch_weights_file_path,
         filter_library_path=None,
         observations=None,
+        bfloat16=False,
+        cache_size=4096,
+        num_threads=None,
     ):
         """
         :param metadata_file_path: Metadata json file (see README for specs)
@@ -27,7 +109,19 @@ class Model:
         :param observations: an Observations object that will always be used, otherwise times, filters, etc.
         must be specified anew each time Model.predict_magnitudes() is called
         :type observations: class `kilonovanet.observations.Observations`, optional
+        :param bfloat16: run the decoder in bfloat16 instead of float32; faster on hardware with native bf16
+        support, at the cost of ~1e-2 relative error in the spectra
+        :type bfloat16: bool, optional
+        :param cache_size: number of parameter vectors whose magnitudes are cached when predicting for an
+        Observations object (0 disables the cache)
+        :type cache_size: int, optional
+        :param num_threads: number of threads torch uses (process-wide); defaults to the
+        KILONOVANET_TORCH_THREADS environment variable, or 1
+        :type num_threads: int, optional
         """
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
         with open(metadata_file_path) as json_file:
             metadata = json.load(json_file)
 
@@ -53,33 +147,71 @@ class Model:
         self.x_transforms = {int(k): v for k, v in metadata["x_transforms"].items()}
         self.x_transform_rules = metadata["x_transforms_exp_rules"]
         self.y_transforms = metadata["y_transforms"]
+        # 10 ** (y * (max - min) + min) - bias, rewritten as exp(y * scale + offset) - bias
+        self._y_scale = np.log(10.0) * (self.y_transforms[2] - self.y_transforms[1])
+        self._y_offset = np.log(10.0) * self.y_transforms[1]
+        self._y_bias = self.y_transforms[0]
         self.num_samples = 1
         self.model_type = metadata["wavelengths_style"]
 
+        # per-column input transforms as arrays, so physical_inputs_to_nn works on the whole matrix at once
+        self._x_lo = np.array([self.x_transforms[i][0] for i in range(self.input_size)])
+        self._x_range = (
+            np.array([self.x_transforms[i][1] for i in range(self.input_size)])
+            - self._x_lo
+        )
+        self._x_log = np.array(self.x_transform_rules, dtype=bool)
+        self._x_sign = np.ones(self.input_size)
+        if self.model_type == "kasen" and self._x_log[2]:
+            self._x_sign[2] = -1.0
+
         self.nn_model = CVAE(
             self.spectrum_size, self.hidden_units, self.latent_units, self.input_size
         )
         # This will throw an error if you've provided a model of the wrong size
-        self.nn_model.load_state_dict(
-            torch.load(pytorch_weights_file_path, map_location=torch.device("cpu"))
-        )
+        # the model keeps the shared state dict alive, see _WEIGHTS_CACHE
+        self._weights_key = _weights_key(pytorch_weights_file_path)
+        self._state_dict = _load_weights(self._weights_key)
+        self.nn_model.load_state_dict(self._state_dict, assign=True)
         self.nn_model.eval()
+        self.nn_model.requires_grad_(False)
+        self._torch_dtype = torch.bfloat16 if bfloat16 else torch.float
+        self.nn_model.to(self._torch_dtype)
+
+        self._decoder = self._compile_decoder()
+        self._cache_size = cache_size
+        self._cached_observed_magnitudes = lru_cache(maxsize=self._cache_size)(
+            self._observed_magnitudes
+        )
 
         # read in filters, if specified
         # filename must end with .dat and to access the filter later, use the filename sans .dat
         if filter_library_path:
-            self.filter_library = {}
-            for f in os.listdir(filter_library_path):
-                if f.endswith("dat"):
-                    filter_data = np.loadtxt(os.path.join(filter_library_path, f))
-                    pyphot_filter = Filter(
-                        filter_data.T[0] * unit["AA"],
-                        filter_data.T[1],
-                        name=f[:-4],
-                        dtype="photon",
-                        unit="Angstrom",
-                    )
-                    self.filter_library[f[:-4]] = pyphot_filter
+            filter_files = [
+                os.path.join(filter_library_path, f)
+                for f in os.listdir(filter_library_path)
+                if f.endswith("dat")
+            ]
+            # parsing the text files dominates start-up, so read them concurrently
+            with ThreadPoolExecutor() as executor:
+                self.filter_library = dict(executor.map(_load_filter, filter_files))
+            # the filter integrals over the fixed model wavelength grid, one column per filter
+            self._filter_columns = {
+                name: i for i, name in enumerate(self.filter_library)
+            }
+            self._filter_weights = np.stack(
+                [
+                    _photon_weights(pyphot_filter, self.model_wavelengths)
+                    for pyphot_filter in self.filter_library.values()
+                ],
+                axis=1,
+            )
+            self._ab_zero_mags = np.array(
+                [
+                    pyphot_filter.AB_zero_mag
+                    for pyphot_filter in self.filter_library.values()
+                ]
+            )
             self.filters_loaded = True
         else:
             self.filters_loaded = False
@@ -88,26 +220,56 @@ class Model:
             self.observations = observations
         else:
             self.observations = None
+        # filter weights and zero points of the filters used by each Observations object predicted for
+        self._observed_filter_weights = {}
 
-    def predict_spectra(self, physical_parameters, times):
-        unique_times = np.unique(times)
-
-        # check that the parameters are all in the ranges specified by simulation authors (we do NOT extrapolate)
+    def __getstate__(self):
+        # traced modules and lru caches cannot be pickled (e.g. when handing the model to a multiprocessing
+        # pool), so drop them and rebuild them on unpickling
+        # the shared state dict is only needed to keep the weights cache alive
+        state = self.__dict__.copy()
+        del state["_state_dict"]
+        del state["_decoder"]
+        del state["_cached_observed_magnitudes"]
+        return state
 
-        message = "One of your input parameters is outside of the published range of the simulation. Please check the original papers to learn what the simulated ranges of input parameters were and therefore what is allowed input for the kilonovanet surrogate models."
-        for i, param in enumerate(physical_parameters):
-            if not self.x_transform_rules[i]:
-                assert param <= self.x_transforms[i][1] and param >= self.x_transforms[i][0], message
-            else:
-                if self.model_type == 'kasen':
-                    if i == '2':
-                        assert np.log10(param) <= -1*self.x_transforms[i][1] and np.log10(param) >= -1*self.x_transforms[i][0], message
-                else:
-                    assert np.log10(param) <= self.x_transforms[i][1] and np.log10(param) >= self.x_transforms[i][0], message
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._decoder = self._compile_decoder()
+        self._cached_observed_magnitudes = lru_cache(maxsize=self._cache_size)(
+            self._observed_magnitudes
+        )
 
-            
+    def _compile_decoder(self):
+        # the decoder is a small MLP, so eager per-op dispatch dominates its runtime; tracing it once
+        # and freezing the graph lets torch fuse and constant-fold the layers
+        key = self._weights_key + (self._torch_dtype,)
+        decoder = _DECODER_CACHE.get(key)
+        if decoder is None:
+            example_input = torch.zeros(
+                (1, self.latent_units + self.input_size), dtype=self._torch_dtype
+            )
+            # recent torch releases deprecate torch.jit in favour of torch.compile, which needs a C
+            # toolchain and recompiles whenever the number of unique times changes; the jit path
+            # still works, so only its deprecation warnings are silenced
+            with warnings.catch_warnings(), torch.no_grad():
+                warnings.simplefilter("ignore", FutureWarning)
+                traced_decoder = torch.jit.trace(self.nn_model.decoder, example_input)
+                decoder = torch.jit.optimize_for_inference(traced_decoder)
+            _DECODER_CACHE[key] = decoder
+        return decoder
 
+    def predict_spectra(self, physical_parameters, times):
+        if self.observations is not None and times is self.observations.times:
+            unique_times = self.observations._unique_times
+        else:
+            unique_times = np.unique(times)
+        reconstructions = self._reconstruct_spectra(physical_parameters, unique_times)
+        spectra_nn = self.spectra_to_real_units(reconstructions)
+        return spectra_nn, unique_times
 
+    def _reconstruct_spectra(self, physical_parameters, unique_times):
+        # decoder output in the normalised [0, 1] units the cVAE was trained on, one row per unique time
         all_data_input = np.hstack(
             (
                 np.repeat(
@@ -117,19 +279,25 @@ class Model:
             )
         )
         nn_input = self.physical_inputs_to_nn(all_data_input)
-        with torch.no_grad():
-            z = (
-                torch.zeros((1, self.latent_units))
-                .repeat((len(nn_input), 1))
-                .to(torch.float)
-            )
-            decoder_input = torch.cat(
-                (z, torch.from_numpy(nn_input).to(torch.float)), dim=1
-            )
-            reconstructions = self.nn_model.decoder(decoder_input)
-        reconstructions_np = reconstructions.double().cpu().detach().numpy()
-        spectra_nn = self.spectra_to_real_units(reconstructions_np)
-        return spectra_nn, unique_times
+
+        # check that the parameters are all in the ranges specified by simulation authors (we do NOT extrapolate)
+        # i.e. that their normalised network inputs lie within [0, 1]
+        message = "One of your input parameters is outside of the published range of the simulation. Please check the original papers to learn what the simulated ranges of input parameters were and therefore what is allowed input for the kilonovanet surrogate models."
+        normalised_parameters = nn_input[:, :-1]
+        assert np.all(
+            (normalised_parameters >= 0.0) & (normalised_parameters <= 1.0)
+        ), message
+
+        # allocated per call so that the model can be used from several threads at once; the latent
+        # part stays at zero (the mean)
+        decoder_input = torch.zeros(
+            (len(nn_input), self.latent_units + self.input_size), dtype=self._torch_dtype
+        )
+        decoder_input[:, self.latent_units :].copy_(torch.from_numpy(nn_input))
+        with torch.inference_mode():
+            reconstructions = self._decoder(decoder_input)
+        reconstructions_np = reconstructions.float().numpy()
+        return reconstructions_np
 
     def predict_magnitudes(
         self, physical_parameters, times=None, filters=None, distance=None
@@ -143,83 +311,99 @@ class Model:
         :return:
         """
         if self.observations is not None:
-            # Using the Observations object inputs
-            spectra_from_nn, unique_times = self.predict_spectra(
-                physical_parameters, self.observations.times
-            )
-            spectra_at_distance = spectra_from_nn / (
-                4 * np.pi * self.observations.distance ** 2
+            # Using the Observations object inputs; samplers call this with the same observations over and
+            # over, so results are memoised on the exact parameter values
+            magnitudes = self._cached_observed_magnitudes(
+                self.observations,
+                self.observations.distance,
+                tuple(np.asarray(physical_parameters).tolist()),
             )
-            magnitudes = np.empty_like(self.observations.times)
-
-            for f in self.observations.filters_unique:
-                filter_indices = np.where(self.observations.filters == f)
-                times_of_filter = self.observations.times[filter_indices]
-                spectra_of_filter = spectra_at_distance[
-                    np.searchsorted(unique_times, times_of_filter)
-                ]
-                ff = self.filter_library[f]
-                flux = ff.get_flux(
-                    self.model_wavelengths * unit["AA"],
-                    spectra_of_filter * unit["flam"],
-                )
-                mag = -2.5 * np.log10(flux) - ff.AB_zero_mag
-                magnitudes[filter_indices] = mag
-
+            return magnitudes.copy()
         elif times is not None:
-            spectra_from_nn, unique_times = self.predict_spectra(
-                physical_parameters, times
+            (
+                unique_times,
+                time_rows,
+                filters_unique,
+                filter_indices,
+            ) = index_observations(times, filters)
+            return self._predict_magnitudes(
+                physical_parameters,
+                unique_times,
+                time_rows,
+                filter_indices,
+                *self._filter_weights_of(filters_unique),
+                distance,
             )
-            spectra_at_distance = spectra_from_nn / (4 * np.pi * distance ** 2)
-            magnitudes = np.empty_like(times)
-            filters_unique = np.unique(filters)
-
-            for f in filters_unique:
-                filter_indices = np.where(filters == f)
-                times_of_filter = times[filter_indices]
-                spectra_of_filter = spectra_at_distance[
-                    np.searchsorted(unique_times, times_of_filter)
-                ]
-                ff = self.filter_library[f]
-                flux = ff.get_flux(
-                    self.model_wavelengths * unit["AA"],
-                    spectra_of_filter * unit["flam"],
-                )
-                mag = -2.5 * np.log10(flux) - ff.AB_zero_mag
-                magnitudes[filter_indices] = mag
-
         else:
             raise ValueError(
                 "Neither Observations object nor times post merger to predict at specified."
             )
 
-        return magnitudes
+    def _observed_magnitudes(self, observations, distance, physical_parameters):
+        # distance is passed separately (rather than read from observations) so that it is part of
+        # the cache key, e.g. when fitting for it by updating observations.distance
+        if observations not in self._observed_filter_weights:
+            self._observed_filter_weights[observations] = self._filter_weights_of(
+                observations.filters_unique
+            )
+        return self._predict_magnitudes(
+            np.array(physical_parameters),
+            observations._unique_times,
+            observations._time_rows,
+            observations._filter_indices,
+            *self._observed_filter_weights[observations],
+            distance,
+        )
+
+    def _filter_weights_of(self, filters_unique):
+        # the columns of the filter weight matrix and the zero points of the given filters
+        columns = np.array([self._filter_columns[f] for f in filters_unique])
+        return (
+            np.ascontiguousarray(self._filter_weights[:, columns]),
+            self._ab_zero_mags[columns],
+        )
+
+    def _predict_magnitudes(
+        self,
+        physical_parameters,
+        unique_times,
+        time_rows,
+        filter_indices,
+        filter_weights,
+        ab_zero_mags,
+        distance,
+    ):
+        # time_rows / filter_indices: per observation, the index of its time in unique_times and
+        # of its filter in the columns of filter_weights / ab_zero_mags
+        reconstructions = self._reconstruct_spectra(physical_parameters, unique_times)
+        spectra_at_distance = self.spectra_to_real_units_at_distance(
+            reconstructions, distance
+        )
+
+        # integrate every spectrum through every filter in one matrix product, then pick out the
+        # (time, filter) pair of each observation
+        magnitudes = spectra_at_distance @ filter_weights
+        np.log10(magnitudes, out=magnitudes)
+        magnitudes *= -2.5
+        magnitudes -= ab_zero_mags
+        return magnitudes[time_rows, filter_indices]
 
     def physical_inputs_to_nn(self, param_matrix):
-        param_matrix_new = np.empty_like(param_matrix.T)
-        for i, rule in zip(range(len(param_matrix.T)), self.x_transform_rules):
-            if not rule:
-                param_matrix_new[i] = (param_matrix.T[i] - self.x_transforms[i][0]) / (
-                    self.x_transforms[i][1] - self.x_transforms[i][0]
-                )
-            if rule:
-                if i == 2 and self.model_type == "kasen":
-                    param_matrix_new[i] = (
-                        -1 * np.log10(param_matrix.T[i]) - self.x_transforms[i][0]
-                    ) / (self.x_transforms[i][1] - self.x_transforms[i][0])
-                else:
-                    param_matrix_new[i] = (
-                        np.log10(param_matrix.T[i]) - self.x_transforms[i][0]
-                    ) / (self.x_transforms[i][1] - self.x_transforms[i][0])
-
-        return param_matrix_new.T
+        param_matrix_new = np.array(param_matrix, dtype=float)
+        param_matrix_new[..., self._x_log] = self._x_sign[self._x_log] * np.log10(
+            param_matrix_new[..., self._x_log]
+        )
+        param_matrix_new -= self._x_lo
+        param_matrix_new /= self._x_range
+        return param_matrix_new
 
     def spectra_to_real_units(self, y):
         # returns erg/s/Hz
-        return (
-            10.0
-            ** (
-                y * (self.y_transforms[2] - self.y_transforms[1]) + self.y_transforms[1]
-            )
-            - self.y_transforms[0]
+        return _exp_minus_bias(y, self._y_scale, self._y_offset, self._y_bias)
+
+    def spectra_to_real_units_at_distance(self, y, distance):
+        # spectra_to_real_units(y) / (4 pi distance^2), with the dilution folded into the exponent
+        area = 4 * np.pi * distance ** 2
+        return _exp_minus_bias(
+            y, self._y_scale, self._y_offset - np.log(area), self._y_bias / area
         )
@@ -4,7 +4,9 @@ import numpy as np
 class Observations:
     def __init__(self, times, filters, data_magnitudes, magnitude_errors, distance):
         """
-        Static object to hold the observations for a kilonova
+        Static object to hold the observations for a kilonova. The times and filters are indexed on
+        construction, so they must not be changed afterwards (create a new Observations instead);
+        the distance may be changed at any time.
         :param times:
         :param filters:
         :param data_magnitudes:
@@ -20,3 +22,27 @@ class Observations:
         self.upper_limit = np.invert(np.isfinite(self.magnitude_errors))
         self.upper_limit_indices = np.where(self.upper_limit)[0]
         self.distance = distance
+        (
+            self._unique_times,
+            self._time_rows,
+            _,
+            self._filter_indices,
+        ) = index_observations(self.times, self.filters)
+
+
+def index_observations(times, filters):
+    """
+    Index arrays used to pick predicted magnitudes for each observation
+    :param times: times of the observations
+    :param filters: filter names of the observations
+    :return: np.unique(times), per observation the index of its time in it, np.unique(filters), and
+    per observation the index of its filter in it
+    """
+    unique_times, time_rows = np.unique(times, return_inverse=True)
+    filters_unique, filter_indices = np.unique(filters, return_inverse=True)
+    return (
+        unique_times,
+        time_rows.reshape(-1),
+        filters_unique,
+        filter_indices.reshape(-1),
+    )
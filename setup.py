@@ -23,6 +23,6 @@ setup(
     description="Kilonova surrogate modelling via cVAE",
     long_description=long_description,
     long_description_content_type="text/markdown",
-    install_requires=["numpy", "torch", "pyphot"],
-    python_requires='>=3.6'
+    install_requires=["numpy", "torch>=2.1", "pyphot"],
+    python_requires='>=3.8'
 )
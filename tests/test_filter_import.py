@@ -1,4 +1,6 @@
 import kilonovanet
+import numpy as np
+from pyphot import unit
 import pytest
 
 
@@ -28,3 +30,18 @@ def test_filter_imports(metadata, torch_file):
 
     model2 = kilonovanet.Model(metadata, torch_file)
     assert not model2.filters_loaded
+
+
+@pytest.mark.parametrize(
+    "metadata, torch_file", [(m, t) for m, t, in zip(METADATA, MODELS)]
+)
+def test_filter_weights_match_pyphot(metadata, torch_file):
+    # Test that the precomputed filter integrals reproduce pyphot's photon flux
+    model = kilonovanet.Model(metadata, torch_file, filter_library_path=FILTER_LIB)
+    spectra = np.random.default_rng(42).uniform(1.0, 2.0, (3, model.spectrum_size))
+    for name, pyphot_filter in model.filter_library.items():
+        flux_pyphot = pyphot_filter.get_flux(
+            model.model_wavelengths * unit["AA"], spectra * unit["flam"]
+        )
+        weights = model._filter_weights[:, model._filter_columns[name]]
+        np.testing.assert_allclose(spectra @ weights, flux_pyphot, rtol=1e-10)
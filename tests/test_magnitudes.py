@@ -1,3 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import os
+import pickle
 import kilonovanet
 import numpy as np
 import torch
@@ -73,6 +77,22 @@ def test_correct_output_no_obs(metadata, torch_file, params, times, output, tole
     np.testing.assert_allclose(mags, output, atol=tolerance)
 
 
+@pytest.mark.parametrize(
+    "metadata, torch_file, params, times, output, tolerance", INPUTS1
+)
+def test_correct_output_bfloat16(
+    metadata, torch_file, params, times, output, tolerance
+):
+    # Test that running the decoder in bfloat16 stays within the same tolerances
+    model = kilonovanet.Model(
+        metadata, torch_file, filter_library_path=FILTER_LIB, bfloat16=True
+    )
+    mags = model.predict_magnitudes(
+        params, times=times, distance=DISTANCE, filters=FILTERS,
+    )
+    np.testing.assert_allclose(mags, output, atol=tolerance)
+
+
 @pytest.mark.parametrize("metadata, torch_file, params, times", INPUTS2)
 def test_matching_outputs(metadata, torch_file, params, times):
     # Test that the no-Obs and Obs ways of producing output does the same thing
@@ -90,3 +110,117 @@ def test_matching_outputs(metadata, torch_file, params, times):
     mags2 = model2.predict_magnitudes(params)
 
     np.testing.assert_allclose(mags1, mags2, atol=0.06)
+
+
+@pytest.mark.parametrize("metadata, torch_file, params, times", INPUTS2)
+def test_pickled_model(metadata, torch_file, params, times):
+    # Test that a model survives pickling (e.g. for multiprocessing pools) and predicts the same
+    model1 = kilonovanet.Model(metadata, torch_file, filter_library_path=FILTER_LIB)
+    model2 = pickle.loads(pickle.dumps(model1))
+    mags1 = model1.predict_magnitudes(
+        params, times=times, distance=DISTANCE, filters=FILTERS,
+    )
+    mags2 = model2.predict_magnitudes(
+        params, times=times, distance=DISTANCE, filters=FILTERS,
+    )
+
+    np.testing.assert_allclose(mags1, mags2)
+
+
+@pytest.mark.parametrize("metadata, torch_file, params, times", INPUTS2)
+def test_cached_outputs(metadata, torch_file, params, times):
+    # Test that repeated predictions for an Observations object come from the cache unchanged
+    obs = kilonovanet.Observations(
+        times, FILTERS, np.array([0.0, 0.0, 0]), np.array([0.0, 0.0, 0]), DISTANCE,
+    )
+    model = kilonovanet.Model(
+        metadata, torch_file, filter_library_path=FILTER_LIB, observations=obs
+    )
+    mags1 = model.predict_magnitudes(params)
+    mags1_copy = mags1.copy()
+    mags1[:] = 0.0
+    mags2 = model.predict_magnitudes(params.copy())
+
+    assert model._cached_observed_magnitudes.cache_info().hits == 1
+    np.testing.assert_array_equal(mags1_copy, mags2)
+    model3 = pickle.loads(pickle.dumps(model))
+    np.testing.assert_allclose(model3.predict_magnitudes(params), mags2)
+
+
+@pytest.mark.parametrize("metadata, torch_file, params, times", INPUTS2)
+def test_parameters_out_of_range(metadata, torch_file, params, times):
+    # Test that parameters outside of the simulated ranges are refused rather than extrapolated
+    model = kilonovanet.Model(metadata, torch_file)
+    for i in range(len(params)):
+        bad_params = params.copy()
+        bad_params[i] *= 1.0e3
+        with pytest.raises(AssertionError):
+            model.predict_spectra(bad_params, times)
+
+
+@pytest.mark.parametrize("metadata, torch_file, params, times", INPUTS2)
+def test_cached_outputs_distance(metadata, torch_file, params, times):
+    # Test that changing the Observations distance is not served from the cache
+    obs = kilonovanet.Observations(
+        times, FILTERS, np.array([0.0, 0.0, 0]), np.array([0.0, 0.0, 0]), DISTANCE,
+    )
+    model = kilonovanet.Model(
+        metadata, torch_file, filter_library_path=FILTER_LIB, observations=obs
+    )
+    mags1 = model.predict_magnitudes(params)
+    obs.distance = 2 * DISTANCE
+    mags2 = model.predict_magnitudes(params)
+
+    np.testing.assert_allclose(mags2 - mags1, 5 * np.log10(2), rtol=1e-6)
+
+
+@pytest.mark.parametrize("metadata, torch_file, params, times", INPUTS2)
+def test_physical_inputs_to_nn_row(metadata, torch_file, params, times):
+    # Test that a single row is transformed the same way as a matrix of rows
+    model = kilonovanet.Model(metadata, torch_file)
+    row = np.append(params, times[0])
+    np.testing.assert_array_equal(
+        model.physical_inputs_to_nn(row), model.physical_inputs_to_nn(row[None])[0]
+    )
+
+
+@pytest.mark.parametrize("metadata, torch_file, params, times", INPUTS2)
+def test_shared_weights(metadata, torch_file, params, times, tmp_path):
+    # Test that models built from the same weights file share them, that rewriting the file neither
+    # changes existing models nor is served from the cache, and that unused weights are released
+    weights_file = str(tmp_path / "weights.pt")
+    state_dict = torch.load(torch_file, map_location="cpu")
+    torch.save(state_dict, weights_file)
+    model1 = kilonovanet.Model(metadata, weights_file)
+    model2 = kilonovanet.Model(metadata, weights_file)
+    assert model1._decoder is model2._decoder
+    spectra1 = model1.predict_spectra(params, times)[0]
+
+    torch.save({k: v * 1.01 for k, v in state_dict.items()}, weights_file)
+    # make sure the rewrite is seen even on file systems with coarse timestamps
+    mtime_ns = os.stat(weights_file).st_mtime_ns + 10 ** 9
+    os.utime(weights_file, ns=(mtime_ns, mtime_ns))
+    model3 = kilonovanet.Model(metadata, weights_file)
+    assert model3._decoder is not model1._decoder
+    np.testing.assert_array_equal(model1.predict_spectra(params, times)[0], spectra1)
+    assert not np.allclose(model3.predict_spectra(params, times)[0], spectra1)
+
+    weights_key = model1._weights_key
+    del model1, model2
+    gc.collect()
+    assert weights_key not in kilonovanet.kilonovanet._WEIGHTS_CACHE
+
+
+@pytest.mark.parametrize("metadata, torch_file, params, times", INPUTS2)
+def test_threaded_predictions(metadata, torch_file, params, times):
+    # Test that a model shared between threads predicts the same spectra as serial calls
+    model = kilonovanet.Model(metadata, torch_file)
+    rng = np.random.default_rng(42)
+    all_times = [rng.uniform(1.0, 10.0, 20) for _ in range(200)]
+    serial = [model.predict_spectra(params, t)[0] for t in all_times]
+    with ThreadPoolExecutor(8) as executor:
+        threaded = list(
+            executor.map(lambda t: model.predict_spectra(params, t)[0], all_times)
+        )
+    for spectra_serial, spectra_threaded in zip(serial, threaded):
+        np.testing.assert_array_equal(spectra_serial, spectra_threaded)